@@ -1,10 +1,15 @@
 import bcrypt
 from datetime import datetime
+import hashlib
+import hmac
+import time
 import uuid
 
 from email_validator import validate_email
 from flask import session
 from flask_login import login_user
+import gevent
+from gevent import monkey
 from keycloak import KeycloakAdmin as KeycloakAdmin_
 from keycloak import KeycloakOpenID
 from keycloak.exceptions import KeycloakError, KeycloakGetError
@@ -24,6 +29,49 @@ from .misc import logger
 from . import misc
 
 
+# Recent successful password verifications, so that clients logging in
+# repeatedly don't redo the (deliberately slow) bcrypt hashing every time.
+# Maps a HMAC of the user id, password hash and password to an expiry time.
+VERIFIED_PASSWORDS = {}
+VERIFIED_PASSWORD_TTL = 30
+VERIFIED_PASSWORDS_MAX = 10000
+
+
+def checkpw_in_threadpool(password, hashed):
+    """Runs bcrypt.checkpw in gevent's native thread pool when gevent has
+    patched the standard library, so other greenlets keep running while it
+    hashes (bcrypt releases the GIL)."""
+    if monkey.is_module_patched("threading"):
+        return gevent.get_hub().threadpool.apply(bcrypt.checkpw, (password, hashed))
+    return bcrypt.checkpw(password, hashed)
+
+
+def verify_bcrypt_password(user, password):
+    """ Checks `password` against the bcrypt hash stored for `user` """
+    key = hmac.new(
+        config.app.secret_key.encode("utf-8"),
+        f"{user.uid}:{user.password}:{password}".encode("utf-8"),
+        hashlib.sha256,
+    ).digest()
+    now = time.monotonic()
+    if VERIFIED_PASSWORDS.get(key, 0) > now:
+        return True
+
+    if not checkpw_in_threadpool(
+        password.encode("utf-8"), user.password.encode("utf-8")
+    ):
+        return False
+
+    if len(VERIFIED_PASSWORDS) >= VERIFIED_PASSWORDS_MAX:
+        for k, expires in list(VERIFIED_PASSWORDS.items()):
+            if expires <= now:
+                del VERIFIED_PASSWORDS[k]
+        if len(VERIFIED_PASSWORDS) >= VERIFIED_PASSWORDS_MAX:
+            VERIFIED_PASSWORDS.clear()
+    VERIFIED_PASSWORDS[key] = now + VERIFIED_PASSWORD_TTL
+    return True
+
+
 # Fix an unhandled error in python-keycloak.
 # See github.com/marcospereirampj/python-keycloak, pull requests 92 and 99.
 class KeycloakAdmin(KeycloakAdmin_):
@@ -353,10 +401,7 @@ class AuthProvider:
 
     def validate_password(self, user, password):
         if user.crypto == UserCrypto.BCRYPT:
-            thash = bcrypt.hashpw(
-                password.encode("utf-8"), user.password.encode("utf-8")
-            )
-            if thash == user.password.encode("utf-8"):
+            if verify_bcrypt_password(user, password):
                 if self.provider == "KEYCLOAK":
                     kuid = self.keycloak_admin.create_user(
                         {
@@ -43,6 +43,7 @@ defaults = {  # key => default value
         },
         "trusted_proxy_count": 0,
         "custom_hot_sort": False,
+        "defer_user_scores": False,
         "icon_url": None,
         "logo": "app/static/img/throat-logo.svg",
     },
@@ -1,5 +1,6 @@
 """ Misc helper function and classes. """
 import hashlib
+from html import unescape
 from urllib.parse import urlparse, parse_qs
 import json
 import math
@@ -15,8 +16,8 @@ import ipaddress
 from collections import defaultdict
 from functools import wraps
 
-from bs4 import BeautifulSoup
 import tinycss2
+from tinycss2.ast import AtRule, CurlyBracketsBlock, ParseError, QualifiedRule, URLToken
 from captcha.image import ImageCaptcha
 from datetime import datetime, timedelta, timezone
 import misaka as m
@@ -134,6 +135,8 @@ class SiteUser(object):
     def __init__(self, userclass=None, subs=(), prefs=()):
         self.user = userclass
         self.notifications = self.user.get("notifications", 0)
+        self.unread_messages = self.user.get("messages", 0)
+        self.unread_notifications = self.notifications - self.unread_messages
         self.open_reports = self.user.get("open_reports", 0)
         self.name = self.user["name"]
         self.uid = self.user["uid"]
@@ -511,6 +514,106 @@ def our_markdown(text):
     return html
 
 
+# Part of the cache keys for rendered markdown. Bump it whenever a change to
+# `our_markdown` should invalidate the HTML rendered by the old version.
+MARKDOWN_RENDERER_VERSION = 1
+
+
+def markdown_cache_key(text):
+    return "md-{0}-{1}".format(
+        MARKDOWN_RENDERER_VERSION,
+        hashlib.blake2b(text.encode(), digest_size=16).hexdigest(),
+    )
+
+
+def cached_markdown(text):
+    """Renders markdown with `our_markdown`, caching the result by the hash
+    of the text."""
+    key = markdown_cache_key(text)
+    html = cache.get(key)
+    if html is None:
+        html = our_markdown(text)
+        cache.set(key, html, timeout=86400)
+    return html
+
+
+def cached_markdown_many(texts):
+    """Like `cached_markdown`, for a list of texts. Looks up all of them in a
+    single cache round trip and only renders the ones that weren't cached."""
+    keys = [markdown_cache_key(text) for text in texts]
+    rendered = cache.get_many(*keys) if keys else []
+    missing = {}
+    for i, html in enumerate(rendered):
+        if html is None:
+            rendered[i] = missing[keys[i]] = our_markdown(texts[i])
+    if missing:
+        cache.set_many(missing, timeout=86400)
+    return rendered
+
+
+def uuid7():
+    """Returns a version 7 UUID, which starts with the current time in
+    milliseconds so that new ones sort after older ones. Used for primary
+    keys on busy tables, where random keys scatter the inserts all over
+    the index."""
+    rand = int.from_bytes(os.urandom(10), "big")
+    value = (time.time_ns() // 1000000) << 80  # 48 bit timestamp
+    value |= 0x7 << 76  # version
+    value |= ((rand >> 62) & 0xFFF) << 64  # 12 random bits
+    value |= 0x2 << 62  # variant
+    value |= rand & ((1 << 62) - 1)  # 62 random bits
+    return uuid.UUID(int=value)
+
+
+def post_cache_key(prefix, pid, *args):
+    """Returns a cache key for data about the post `pid`, which changes
+    whenever `bump_post_version` is called for it."""
+    version = cache.get("post-ver-{0}".format(pid)) or 0
+    return "-".join(str(x) for x in (prefix, pid, version) + args)
+
+
+def bump_post_version(pid):
+    """ Invalidates the data cached with keys from `post_cache_key` """
+    cache.set("post-ver-{0}".format(pid), uuid.uuid4().hex, timeout=86400)
+
+
+def memoize_per_request(func):
+    """Keeps the results of `func` on the request context until the request ends.
+    Calls with unhashable arguments are not memoized."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not has_request_context():
+            return func(*args, **kwargs)
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        # Kept on the request context rather than `g`, which belongs to the
+        # app context and can outlive the request.
+        ctx = _request_ctx_stack.top
+        if not hasattr(ctx, "memo"):
+            ctx.memo = {}
+        memo = ctx.memo
+        try:
+            return memo[key]
+        except TypeError:
+            return func(*args, **kwargs)
+        except KeyError:
+            memo[key] = func(*args, **kwargs)
+            return memo[key]
+
+    return wrapper
+
+
+def active_sub_ban(sid, uid):
+    """ Returns the condition matching the bans in effect for `uid` on `sid` """
+    return (
+        (SubBan.sid == sid)
+        & (SubBan.uid == uid)
+        & SubBan.effective
+        & (SubBan.expires.is_null(True) | (SubBan.expires > datetime.utcnow()))
+    )
+
+
+@memoize_per_request
 @cache.memoize(5)
 def is_sub_banned(sub, user=None, uid=None):
     """ Returns True if 'user' is banned 'sub' """
@@ -523,17 +626,7 @@ def is_sub_banned(sub, user=None, uid=None):
     if not uid:
         uid = user["uid"]
     try:
-        SubBan.get(
-            (SubBan.sid == sid)
-            & (SubBan.uid == uid)
-            & (
-                SubBan.effective
-                & (
-                    (SubBan.expires.is_null(True))
-                    | (SubBan.expires > datetime.utcnow())
-                )
-            )
-        )
+        SubBan.get(active_sub_ban(sid, uid))
         return True
     except SubBan.DoesNotExist:
         return False
@@ -1091,11 +1184,18 @@ def postListQueryHome(noDetail=False, nofilter=False):
         )
 
 
-def getPostList(baseQuery, sort, page, page_size=25):
+def getPostList(baseQuery, sort, page, page_size=25, lookahead=0):
+    """Returns a page of posts. `lookahead` posts past the end of the page
+    are included, to tell if there are more pages without counting them."""
+
+    def paginate(query):
+        query = query.limit(page_size + lookahead)
+        return query.offset((max(page, 1) - 1) * page_size)
+
     if sort == "top":
-        posts = baseQuery.order_by(SubPost.score.desc()).paginate(page, page_size)
+        posts = paginate(baseQuery.order_by(SubPost.score.desc()))
     elif sort == "new":
-        posts = baseQuery.order_by(SubPost.pid.desc()).paginate(page, page_size)
+        posts = paginate(baseQuery.order_by(SubPost.pid.desc()))
     else:
         if "Postgresql" in config.database.engine:
             posted = fn.EXTRACT(NodeList((SQL("EPOCH FROM"), SubPost.posted)))
@@ -1108,7 +1208,7 @@ def getPostList(baseQuery, sort, page, page_size=25):
             hot = fn.HOT(SubPost.score, posted)
         else:
             hot = SubPost.score * 20 + (posted - 1134028003) / 1500
-        posts = baseQuery.order_by(hot.desc()).limit(100).paginate(page, page_size)
+        posts = paginate(baseQuery.order_by(hot.desc()))
     return [add_blur(p) for p in posts.dicts()]
 
 
@@ -1215,7 +1315,7 @@ def load_user(user_id):
     # This is the only user attribute needed by the error templates, so stash
     # it in the session so that future errors in this session won't have to
     # load the user to show them the correct language.
-    session["language"] = user["language"]
+    set_session_language(user["language"])
 
     if request.path == "/socket.io/":
         return SiteUser(user, [], [])
@@ -1246,11 +1346,24 @@ def user_is_loaded():
 
 def ensure_locale_loaded():
     if "language" not in session or not session["language"]:
-        session["language"] = get_locale_fallback()
+        set_session_language(get_locale_fallback())
+
+
+def set_session_language(language):
+    """ Stores the language in the session and forgets this request's locale """
+    session["language"] = language
+    g.pop("locale", None)
 
 
 @babel.localeselector
 def get_locale():
+    """ Returns the locale for the request, which is only looked up once """
+    if "locale" not in g:
+        g.locale = select_locale()
+    return g.locale
+
+
+def select_locale():
     language = session.get("language", "sk")
     if language:
         return language
@@ -1382,9 +1495,9 @@ def select_unread_messages(user_id, *args):
     )
 
 
-@cache.memoize(1)
 def get_unread_count():
-    return select_unread_messages(current_user.uid).count()
+    """ Returns the number of unread messages counted when loading the user """
+    return current_user.unread_messages
 
 
 def get_errors(form, first=False):
@@ -1412,10 +1525,49 @@ def get_errors(form, first=False):
 # messages
 
 
-def get_messages_inbox(page, uid=None):
+def paginate_messages(query, page, before=None):
+    """Limit a query selecting message ids ordered by descending `mid` to
+    one page and return the ids. If `before` is given, return the page of
+    messages older than that `mid` instead of using an offset."""
+    if before is not None:
+        query = query.where(Message.mid < before).limit(20)
+    else:
+        query = query.paginate(page, 20)
+    return [mid for (mid,) in query.tuples()]
+
+
+def get_messages_inbox(page, uid=None, before=None):
     """ Returns user's messages inbox as dictionary. """
     if uid is None:
         uid = current_user.uid
+    mids = paginate_messages(
+        Message.select(Message.mid)
+        .join(
+            UserIgnores,
+            JOIN.LEFT_OUTER,
+            on=(
+                (UserIgnores.uid == Message.receivedby)
+                & (UserIgnores.target == Message.sentby)
+            ),
+        )
+        .join(
+            UserMessageMailbox,
+            on=(
+                (UserMessageMailbox.uid == Message.receivedby)
+                & (UserMessageMailbox.mid == Message.mid)
+            ),
+        )
+        .where(
+            (Message.receivedby == uid)
+            & (UserMessageMailbox.mailbox == MessageMailbox.INBOX)
+            & (UserIgnores.uid.is_null() | (Message.mtype != MessageType.USER_TO_USER))
+        )
+        .order_by(Message.mid.desc()),
+        page,
+        before,
+    )
+    if not mids:
+        return []
     Conversation = Message.alias()
     msgs = (
         Message.select(
@@ -1452,30 +1604,36 @@ def get_messages_inbox(page, uid=None):
                 & (UserUnreadMessage.mid == Message.mid)
             ),
         )
-        .join(
-            UserMessageMailbox,
-            JOIN.LEFT_OUTER,
-            on=(
-                (UserMessageMailbox.uid == Message.receivedby)
-                & (UserMessageMailbox.mid == Message.mid)
-            ),
-        )
-        .where(
-            (Message.receivedby == uid)
-            & (UserMessageMailbox.mailbox == MessageMailbox.INBOX)
-            & (UserIgnores.uid.is_null() | (Message.mtype != MessageType.USER_TO_USER))
-        )
+        .where(Message.mid << mids)
         .order_by(Message.mid.desc())
-        .paginate(page, 20)
         .dicts()
     )
     return process_msgs(msgs)
 
 
-def get_messages_sent(page, uid=None):
+def get_messages_sent(page, uid=None, before=None):
     """ Returns messages sent """
     if uid is None:
         uid = current_user.uid
+    mids = paginate_messages(
+        Message.select(Message.mid)
+        .join(
+            UserMessageMailbox,
+            on=(
+                (UserMessageMailbox.uid == uid)
+                & (UserMessageMailbox.mid == Message.mid)
+            ),
+        )
+        .where(
+            (Message.sentby == uid)
+            & (UserMessageMailbox.mailbox == MessageMailbox.SENT)
+        )
+        .order_by(Message.mid.desc()),
+        page,
+        before,
+    )
+    if not mids:
+        return []
     Conversation = Message.alias()
     return process_msgs(
         Message.select(
@@ -1493,28 +1651,36 @@ def get_messages_sent(page, uid=None):
         .join(Conversation, JOIN.LEFT_OUTER, on=(Conversation.mid == Message.reply_to))
         .join(User, JOIN.LEFT_OUTER, on=(User.uid == Message.receivedby))
         .join(Sub, JOIN.LEFT_OUTER, on=(Sub.sid == Message.sub))
+        .where(Message.mid << mids)
+        .order_by(Message.mid.desc())
+        .dicts()
+    )
+
+
+def get_messages_saved(page, uid=None, before=None):
+    """ Returns saved messages """
+    if uid is None:
+        uid = current_user.uid
+    mids = paginate_messages(
+        Message.select(Message.mid)
         .join(
             UserMessageMailbox,
-            JOIN.LEFT_OUTER,
             on=(
-                (UserMessageMailbox.uid == uid)
+                (UserMessageMailbox.uid == Message.receivedby)
                 & (UserMessageMailbox.mid == Message.mid)
             ),
         )
         .where(
-            (Message.sentby == uid)
-            & (UserMessageMailbox.mailbox == MessageMailbox.SENT)
+            (UserMessageMailbox.mailbox == MessageMailbox.SAVED)
+            & (Message.receivedby == uid)
+            & Message.sentby.is_null(False)
         )
-        .order_by(Message.mid.desc())
-        .paginate(page, 20)
-        .dicts()
+        .order_by(Message.mid.desc()),
+        page,
+        before,
     )
-
-
-def get_messages_saved(page, uid=None):
-    """ Returns saved messages """
-    if uid is None:
-        uid = current_user.uid
+    if not mids:
+        return []
     Conversation = Message.alias()
     msgs = (
         Message.select(
@@ -1541,20 +1707,8 @@ def get_messages_saved(page, uid=None):
                 & (UserUnreadMessage.mid == Message.mid)
             ),
         )
-        .join(
-            UserMessageMailbox,
-            JOIN.LEFT_OUTER,
-            on=(
-                (UserMessageMailbox.uid == Message.receivedby)
-                & (UserMessageMailbox.mid == Message.mid)
-            ),
-        )
-        .where(
-            (UserMessageMailbox.mailbox == MessageMailbox.SAVED)
-            & (Message.receivedby == uid)
-        )
+        .where(Message.mid << mids)
         .order_by(Message.mid.desc())
-        .paginate(page, 20)
         .dicts()
     )
     return process_msgs(msgs)
@@ -1637,19 +1791,15 @@ def getSubMods(sid):
         .join(User, on=(User.uid == SubMod.uid))
         .where(SubMod.sid == sid)
     )
-    modsquery = modsquery.where((User.status == 0) & (~SubMod.invite))
+    modsquery = modsquery.where((User.status == 0) & (~SubMod.invite)).dicts()
 
-    owner, mods, janitors, owner_uids, janitor_uids, mod_uids = ({}, {}, {}, [], [], [])
+    # Indexed by power level: owners, mods, janitors.
+    levels = ({}, {}, {})
     for i in modsquery:
-        if i.power_level == 0:
-            owner[i.uid] = i.user.name
-            owner_uids.append(i.uid)
-        elif i.power_level == 1:
-            mods[i.uid] = i.user.name
-            mod_uids.append(i.uid)
-        elif i.power_level == 2:
-            janitors[i.uid] = i.user.name
-            janitor_uids.append(i.uid)
+        if 0 <= i["power_level"] < len(levels):
+            levels[i["power_level"]][i["uid"]] = i["name"]
+    owner, mods, janitors = levels
+    all_uids = list(owner) + list(janitors) + list(mods)
 
     if not owner:
         owner["0"] = config.site.placeholder_account
@@ -1657,7 +1807,7 @@ def getSubMods(sid):
         "owners": owner,
         "mods": mods,
         "janitors": janitors,
-        "all": owner_uids + janitor_uids + mod_uids,
+        "all": all_uids,
     }
 
 
@@ -1805,21 +1955,26 @@ def get_ignores(uid):
     return [x.target for x in UserIgnores.select().where(UserIgnores.uid == uid)]
 
 
-def iter_validate_css(obj, uris):
+def iter_validate_css(obj, uris, rewritten):
+    """Checks the tokens in `obj` for URLs, replacing `%%name%%` upload
+    references with their URLs. Appends the replaced tokens to `rewritten`."""
     for x in obj:
-        if x.__class__.__name__ == "URLToken":
-            if x.value.startswith("%%") and x.value.endswith("%%"):
-                token = x.value.replace("%%", "").strip()
-                if uris.get(token):
-                    x.value = uris.get(token)
+        cls = type(x)
+        if cls is URLToken:
+            value = x.value
+            if value.startswith("%%") and value.endswith("%%"):
+                uri = uris.get(value[2:-2].strip())
+                if uri:
+                    x.value = uri
+                    rewritten.append(x)
             else:
                 return (
                     _("URLs not allowed, uploaded files only"),
                     x.source_column,
                     x.source_line,
                 )
-        elif x.__class__.__name__ == "CurlyBracketsBlock":
-            return iter_validate_css(x.content, {})
+        elif cls is CurlyBracketsBlock:
+            return iter_validate_css(x.content, {}, rewritten)
     return True
 
 
@@ -1830,19 +1985,25 @@ def validate_css(css, sid):
     uris = {}
     for su in SubUploads.select().where(SubUploads.sid == sid):
         uris[su.name] = file_url(su.fileid)
+    rewritten = []
     for x in st:
-        if x.__class__.__name__ == "AtRule":
+        if type(x) is AtRule:
             if x.at_keyword.lower() == "import":
                 return (
                     _("@import token not allowed"),
                     x.source_column,
                     x.source_line,
                 )  # we do not allow @import
-        elif x.__class__.__name__ == "QualifiedRule":  # down the hole we go.
-            validation = iter_validate_css(x.content, uris)
+        elif type(x) is QualifiedRule:  # down the hole we go.
+            validation = iter_validate_css(x.content, uris, rewritten)
             if validation is not True:
                 return validation
 
+    # Serializing strips comments and reports unparseable rules, so it can
+    # only be skipped if there is nothing to change.
+    if not rewritten and "/*" not in css and not any(type(x) is ParseError for x in st):
+        return 0, css
+
     try:
         return 0, tinycss2.serialize(st)
     except TypeError:
@@ -2019,7 +2180,7 @@ def get_postmeta_dicts(pids):
     ).where(SubPostMetadata.pid << pids)
     postmeta_entries = defaultdict(list)
     for pm in postmeta_query:
-        postmeta_entries[pm.pid.pid].append(pm)
+        postmeta_entries[pm.pid_id].append(pm)
 
     postmeta = {pid: {} for pid in pids}
     for k, v in postmeta_entries.items():
@@ -2134,12 +2295,13 @@ def is_domain_banned(addr, domain_type):
     return False
 
 
-def create_captcha():
-    """Generates a captcha image.
-    Returns a tuple with a token and the base64 encoded image"""
-    if not config.site.require_captchas or config.app.testing:
-        return None
-    token = str(uuid.uuid4())
+# Redis list of pre-rendered captchas, filled by `flask captcha fill`.
+CAPTCHA_POOL_KEY = "cap-pool"
+
+
+def generate_captcha():
+    """Renders a new captcha image.
+    Returns a tuple with the base64 encoded image and the expected answer"""
     captchagen = ImageCaptcha(width=250, height=70)
     if random.randint(1, 50) == 1:
         captcha = random.choice(
@@ -2181,6 +2343,31 @@ def create_captcha():
     data = captchagen.generate(captcha.upper())
     b64captcha = base64.b64encode(data.getvalue()).decode()
     captcha = captcha.replace(" ", "").replace("0", "o")
+    return b64captcha, captcha
+
+
+def fill_captcha_pool(size):
+    """Renders captchas until the pool holds `size` of them.
+    Returns the number of captchas added"""
+    added = 0
+    while rconn.llen(CAPTCHA_POOL_KEY) < size:
+        rconn.lpush(CAPTCHA_POOL_KEY, json.dumps(generate_captcha()))
+        added += 1
+    return added
+
+
+def create_captcha():
+    """Generates a captcha image, taking it from the pool of pre-rendered
+    captchas if there are any left.
+    Returns a tuple with a token and the base64 encoded image"""
+    if not config.site.require_captchas or config.app.testing:
+        return None
+    token = str(uuid.uuid4())
+    pooled = rconn.rpop(CAPTCHA_POOL_KEY)
+    if pooled:
+        b64captcha, captcha = json.loads(pooled)
+    else:
+        b64captcha, captcha = generate_captcha()
 
     rconn.setex("cap-" + token, value=captcha, time=300)  # captcha valid for 5 minutes.
 
@@ -2199,6 +2386,12 @@ def validate_captcha(token, response):
     return False
 
 
+def sees_deleted_comments(sid):
+    """Returns True if the logged in user is shown the deleted comments of
+    the sub `sid` in `get_comment_tree`."""
+    return current_user.is_admin() or current_user.is_mod(sid, 1)
+
+
 def get_comment_tree(
     pid,
     sid,
@@ -2232,42 +2425,35 @@ def get_comment_tree(
         )
     sticky_cid = postmeta.get("sticky_cid")
 
-    def build_tree(tuff, rootcid=None):
+    # 1 - Index comments by cid and group them by parent
+    comments = list(comments)
+    by_cid = {}
+    children = defaultdict(list)
+    for i in comments:
+        by_cid[i["cid"]] = i
+        children[i["parentcid"]].append(i)
+
+    def build_tree(rootcid=None):
         """ Builds a comment tree """
-        res = []
-        for i in tuff[::]:
-            if i["parentcid"] == rootcid:
-                tuff.remove(i)
-                i["children"] = build_tree(tuff, rootcid=i["cid"])
-                res.append(i)
+        res = children.get(rootcid, [])
+        for i in res:
+            i["children"] = build_tree(i["cid"])
         return res
 
     # 2 - Build bare comment tree
-    comment_tree = build_tree(list(comments))
+    comment_tree = build_tree()
 
     # 2.1 - get only a branch of the tree if necessary
     if root:
-
-        def select_branch(commentslst, rootcid):
-            """ Finds a branch with a certain root and returns a new tree """
-            for i in commentslst:
-                if i["cid"] == rootcid:
-                    return i
-                k = select_branch(i["children"], rootcid)
-                if k:
-                    return k
-
-        comment_tree = select_branch(comment_tree, root)
+        comment_tree = by_cid.get(root)
         if comment_tree:
             # include the parent of the root for context.
             if comment_tree["parentcid"] is None or not provide_context:
                 comment_tree = [comment_tree]
             else:
-                orig_root = [
-                    x for x in list(comments) if x["cid"] == comment_tree["parentcid"]
-                ]
-                orig_root[0]["children"] = [comment_tree]
-                comment_tree = orig_root
+                orig_root = by_cid[comment_tree["parentcid"]]
+                orig_root["children"] = [comment_tree]
+                comment_tree = [orig_root]
         else:
             return []
     elif sticky_cid is not None:
@@ -2369,37 +2555,34 @@ def get_comment_tree(
     commdata = {}
     is_admin = current_user.is_admin()
     is_mod = current_user.is_mod(sid, 1)
+    deleted_label = _("[Deleted]")
+    # Visibility of deleted comments for the current user, by status. None
+    # means the comment is hidden altogether.
+    status_visibility = {
+        1: "admin-self-del" if is_admin else "mod-self-del" if is_mod else None,
+        2: "mod-del" if is_admin or is_mod else None,
+    }
     for comm in expcomms:
         comm["history"] = []
         comm["visibility"] = ""
         comm["sticky"] = comm["cid"] == sticky_cid
 
-        if comm["status"]:
-            if comm["status"] == 1:
-                if is_admin:
-                    comm["visibility"] = "admin-self-del"
-                elif is_mod:
-                    comm["visibility"] = "mod-self-del"
-                else:
-                    comm["user"] = _("[Deleted]")
-                    comm["uid"] = None
-                    comm["content"] = ""
-                    comm["lastedit"] = None
-                    comm["visibility"] = "none"
-            elif comm["status"] == 2:
-                if is_admin or is_mod:
-                    comm["visibility"] = "mod-del"
-                else:
-                    comm["user"] = _("[Deleted]")
-                    comm["uid"] = None
-                    comm["content"] = ""
-                    comm["lastedit"] = None
-                    comm["visibility"] = "none"
+        status = comm["status"]
+        if status:
+            visibility = status_visibility.get(status, "")
+            if visibility is None:
+                comm["user"] = deleted_label
+                comm["uid"] = None
+                comm["content"] = ""
+                comm["lastedit"] = None
+                comm["visibility"] = "none"
+            else:
+                comm["visibility"] = visibility
 
         if comm["userstatus"] == 10:
-            comm["user"] = _("[Deleted]")
+            comm["user"] = deleted_label
             comm["uid"] = None
-            if comm["status"] == 1:
+            if status == 1:
                 comm["content"] = ""
                 comm["lastedit"] = None
                 comm["visibility"] = "none"
@@ -2407,52 +2590,65 @@ def get_comment_tree(
         commdata[comm["cid"]] = comm
 
     if config.site.edit_history and include_history:
+        # Only comments that were edited have any history.
+        edited_cids = [cid for cid, comm in commdata.items() if comm["lastedit"]]
+    else:
+        edited_cids = []
+
+    if edited_cids:
         history = (
             SubPostCommentHistory.select(
                 SubPostCommentHistory.cid,
                 SubPostCommentHistory.content,
                 SubPostCommentHistory.datetime,
             )
-            .where(SubPostCommentHistory.cid << cid_list)
+            .where(SubPostCommentHistory.cid << edited_cids)
             .order_by(SubPostCommentHistory.datetime.desc())
             .dicts()
         )
-        for hist in history:
-            if hist["cid"] in commdata:
-                hist["content"] = our_markdown(hist["content"])
-                commdata[hist["cid"]]["history"].append(hist)
+        history = list(history)
+        history_by_cid = defaultdict(list)
+        rendered = cached_markdown_many([hist["content"] for hist in history])
+        for hist, html in zip(history, rendered):
+            hist["content"] = html
+            history_by_cid[hist["cid"]].append(hist)
+        for cid, hists in history_by_cid.items():
+            if cid in commdata:
+                commdata[cid]["history"] = hists
+
+    sources = [comment["content"] for comment in commdata.values()]
+    for comment, source, html in zip(
+        commdata.values(), sources, cached_markdown_many(sources)
+    ):
+        comment["source"] = source
+        comment["content"] = html
 
-    def recursive_populate(tree):
+    def populate(tree):
         """ Expands the tree with the data from `commdata` """
         populated_tree = []
-        for i in tree:
-            if not i["cid"]:
-                populated_tree.append(i)
-                continue
-            comment = commdata[i["cid"]]
-            comment["source"] = comment["content"]
-            comment["content"] = our_markdown(comment["content"])
-            comment["children"] = recursive_populate(i["children"])
-            populated_tree.append(comment)
+        pending = [(tree, populated_tree)]
+        while pending:
+            branch, populated = pending.pop()
+            for i in branch:
+                if not i["cid"]:
+                    populated.append(i)
+                    continue
+                comment = commdata[i["cid"]]
+                comment["children"] = []
+                populated.append(comment)
+                pending.append((i["children"], comment["children"]))
         return populated_tree
 
-    comment_tree = recursive_populate(comment_tree)
+    comment_tree = populate(comment_tree)
     return comment_tree
 
 
-@cache.memoize(1)
 def get_notif_count():
     """
     Temporary till we get rid of the old template
      @deprecated
     """
-    return (
-        Notification.select()
-        .where(
-            (Notification.target == current_user.uid) & Notification.read.is_null(True)
-        )
-        .count()
-    )
+    return current_user.unread_notifications
 
 
 def anti_double_post(func):
@@ -2473,6 +2669,81 @@ def anti_double_post(func):
     return wrapper
 
 
+USER_SCORE_DELTA_KEY = "user-score-delta"
+USER_GIVEN_DELTA_KEY = "user-given-delta"
+
+
+def defer_user_score_deltas(author_uid, score, uid, given):
+    """Accumulates vote deltas for the author's score and the voter's given
+    count in redis, to be written to the database by `flush_user_score_deltas`"""
+    pipe = rconn.pipeline()
+    pipe.hincrby(USER_SCORE_DELTA_KEY, author_uid, score)
+    pipe.hincrby(USER_GIVEN_DELTA_KEY, uid, given)
+    pipe.execute()
+
+
+def flush_user_score_deltas():
+    """Writes the score and given deltas accumulated by `defer_user_score_deltas`
+    to the database. Returns the number of users updated"""
+    updated = set()
+    for key, field in (
+        (USER_SCORE_DELTA_KEY, User.score),
+        (USER_GIVEN_DELTA_KEY, User.given),
+    ):
+        # The deltas are moved to another key while they are written, so votes
+        # cast meanwhile are kept for the next run. The key is only deleted
+        # once the update is committed, so a failed flush is retried first.
+        flushing = key + "-flushing"
+        if rconn.exists(flushing):
+            updated |= apply_user_score_deltas(flushing, field)
+        if rconn.exists(key):
+            rconn.rename(key, flushing)
+            updated |= apply_user_score_deltas(flushing, field)
+    return len(updated)
+
+
+def apply_user_score_deltas(key, field):
+    """Adds the deltas in the redis hash `key` to `field` of each user, then
+    deletes the hash. Returns the uids of the users updated"""
+    updated = set()
+    deltas = rconn.hgetall(key)
+    with db.atomic():
+        for uid, delta in deltas.items():
+            uid = uid.decode()
+            if int(delta):
+                User.update({field: field + int(delta)}).where(
+                    User.uid == uid
+                ).execute()
+                updated.add(uid)
+    rconn.delete(key)
+    return updated
+
+
+def broadcast_vote(target_type, pcid, uid, score, status, author_uid, author_score):
+    """ Notifies the voter, the post's room and the author about a vote """
+    if target_type == "post":
+        socketio.emit(
+            "threadscore",
+            {"pid": pcid, "score": score},
+            namespace="/snt",
+            room=pcid,
+        )
+
+        socketio.emit(
+            "yourvote",
+            {"pid": pcid, "status": status, "score": score},
+            namespace="/snt",
+            room="user" + uid,
+        )
+
+    socketio.emit(
+        "uscore",
+        {"score": author_score},
+        namespace="/snt",
+        room="user" + author_uid,
+    )
+
+
 @anti_double_post
 def cast_vote(uid, target_type, pcid, value):
     """Casts a vote in a post.
@@ -2496,54 +2767,83 @@ def cast_vote(uid, target_type, pcid, value):
     else:
         return jsonify(msg=_("Invalid vote value")), 400
 
+    # Fetch the target along with the user's existing vote and any active
+    # ban on the sub in a single query.
     if target_type == "post":
         target_model = SubPost
+        vote_model = SubPostVote
         try:
-            target = SubPost.select(
-                SubPost.uid,
-                SubPost.score,
-                SubPost.upvotes,
-                SubPost.downvotes,
-                SubPost.pid.alias("id"),
-                SubPost.posted,
-                SubPost.sid,
+            target = (
+                SubPost.select(
+                    SubPost.uid,
+                    SubPost.score,
+                    SubPost.upvotes,
+                    SubPost.downvotes,
+                    SubPost.pid.alias("id"),
+                    SubPost.posted,
+                    SubPost.sid,
+                    SubPostVote.xid.alias("vote_id"),
+                    SubPostVote.positive.alias("vote_positive"),
+                    SubBan.id.alias("ban_id"),
+                    User.score.alias("author_score"),
+                )
+                .join(User, on=User.uid == SubPost.uid)
+                .switch(SubPost)
+                .join(
+                    SubPostVote,
+                    JOIN.LEFT_OUTER,
+                    on=((SubPostVote.pid == SubPost.pid) & (SubPostVote.uid == uid)),
+                )
+                .switch(SubPost)
+                .join(SubBan, JOIN.LEFT_OUTER, on=active_sub_ban(SubPost.sid, uid))
+                .where((SubPost.pid == pcid) & (SubPost.deleted == 0))
+                .objects()
+                .get()
             )
-            target = target.where((SubPost.pid == pcid) & (SubPost.deleted == 0)).get()
         except SubPost.DoesNotExist:
             return jsonify(msg=_("Post does not exist")), 404
 
         if target.deleted:
             return jsonify(msg=_("You can't vote on deleted posts")), 400
-
-        try:
-            qvote = (
-                SubPostVote.select()
-                .where(SubPostVote.pid == pcid)
-                .where(SubPostVote.uid == uid)
-                .get()
-            )
-        except SubPostVote.DoesNotExist:
-            qvote = False
     elif target_type == "comment":
         target_model = SubPostComment
+        vote_model = SubPostCommentVote
         try:
-            target = SubPostComment.select(
-                SubPostComment.uid,
-                SubPost.sid,
-                SubPostComment.pid,
-                SubPostComment.status,
-                SubPostComment.score,
-                SubPostComment.upvotes,
-                SubPostComment.downvotes,
-                SubPostComment.cid.alias("id"),
-                SubPostComment.time.alias("posted"),
-            )
             target = (
-                target.join(SubPost)
+                SubPostComment.select(
+                    SubPostComment.uid,
+                    SubPost.sid,
+                    SubPostComment.pid,
+                    SubPostComment.status,
+                    SubPostComment.score,
+                    SubPostComment.upvotes,
+                    SubPostComment.downvotes,
+                    SubPostComment.cid.alias("id"),
+                    SubPostComment.time.alias("posted"),
+                    SubPostCommentVote.xid.alias("vote_id"),
+                    SubPostCommentVote.positive.alias("vote_positive"),
+                    SubBan.id.alias("ban_id"),
+                    User.score.alias("author_score"),
+                )
+                .join(SubPost)
+                .switch(SubPostComment)
+                .join(User, on=User.uid == SubPostComment.uid)
+                .switch(SubPostComment)
+                .join(
+                    SubPostCommentVote,
+                    JOIN.LEFT_OUTER,
+                    on=(
+                        (SubPostCommentVote.cid == SubPostComment.cid)
+                        & (SubPostCommentVote.uid == uid)
+                    ),
+                )
+                .switch(SubPostComment)
+                .join(SubBan, JOIN.LEFT_OUTER, on=active_sub_ban(SubPost.sid, uid))
                 .where(SubPostComment.cid == pcid)
                 .where(SubPostComment.status.is_null(True))
+                .objects()
+                .get()
             )
-            target = target.objects().get()
         except SubPostComment.DoesNotExist:
             return jsonify(msg=_("Comment does not exist")), 404
 
@@ -2551,20 +2851,10 @@ def cast_vote(uid, target_type, pcid, value):
             return jsonify(msg=_("You can't vote on your own comments")), 400
         if target.status:
             return jsonify(msg=_("You can't vote on deleted comments")), 400
-
-        try:
-            qvote = (
-                SubPostCommentVote.select()
-                .where(SubPostCommentVote.cid == pcid)
-                .where(SubPostCommentVote.uid == uid)
-                .get()
-            )
-        except SubPostCommentVote.DoesNotExist:
-            qvote = False
     else:
         return jsonify(msg=_("Invalid target")), 400
 
-    if is_sub_banned(target.sid, uid=user.uid):
+    if target.ban_id is not None:
         return jsonify(msg=_("You are banned on this sub.")), 403
 
     if (datetime.utcnow() - target.posted.replace(tzinfo=None)) > timedelta(
@@ -2574,104 +2864,81 @@ def cast_vote(uid, target_type, pcid, value):
 
     positive = True if voteValue == 1 else False
     undone = False
+    upvotes = downvotes = 0
 
-    if qvote is not False:
-        if bool(qvote.positive) == (True if voteValue == 1 else False):
-            qvote.delete_instance()
+    with db.atomic():
+        if target.vote_id is not None:
+            if bool(target.vote_positive) == positive:
+                vote_model.delete().where(vote_model.xid == target.vote_id).execute()
 
-            if positive:
-                upd_q = target_model.update(
-                    score=target_model.score - voteValue,
-                    upvotes=target_model.upvotes - 1,
-                )
+                if positive:
+                    upvotes = -1
+                else:
+                    downvotes = -1
+                new_score = -voteValue
+                given = -voteValue
+                undone = True
             else:
-                upd_q = target_model.update(
-                    score=target_model.score - voteValue,
-                    downvotes=target_model.downvotes - 1,
+                vote_model.update(positive=positive).where(
+                    vote_model.xid == target.vote_id
+                ).execute()
+
+                if positive:
+                    upvotes, downvotes = 1, -1
+                else:
+                    upvotes, downvotes = -1, 1
+                new_score = voteValue * 2
+                given = voteValue
+        else:  # First vote cast on post
+            now = datetime.utcnow()
+            if target_type == "post":
+                SubPostVote.create(pid=pcid, uid=uid, positive=positive, datetime=now)
+            else:
+                SubPostCommentVote.create(
+                    cid=pcid, uid=uid, positive=positive, datetime=now
                 )
-            new_score = -voteValue
-            undone = True
-            User.update(score=User.score - voteValue).where(
-                User.uid == target.uid
-            ).execute()
-            User.update(given=User.given - voteValue).where(User.uid == uid).execute()
-        else:
-            qvote.positive = positive
-            qvote.save()
 
             if positive:
-                upd_q = target_model.update(
-                    score=target_model.score + (voteValue * 2),
-                    upvotes=target_model.upvotes + 1,
-                    downvotes=target_model.downvotes - 1,
-                )
+                upvotes = 1
             else:
-                upd_q = target_model.update(
-                    score=target_model.score + (voteValue * 2),
-                    upvotes=target_model.upvotes - 1,
-                    downvotes=target_model.downvotes + 1,
-                )
-            new_score = voteValue * 2
-            User.update(score=User.score + (voteValue * 2)).where(
-                User.uid == target.uid
-            ).execute()
-            User.update(given=User.given + voteValue).where(User.uid == uid).execute()
-    else:  # First vote cast on post
-        now = datetime.utcnow()
-        if target_type == "post":
-            SubPostVote.create(pid=pcid, uid=uid, positive=positive, datetime=now)
-        else:
-            SubPostCommentVote.create(
-                cid=pcid, uid=uid, positive=positive, datetime=now
-            )
+                downvotes = 1
+            new_score = voteValue
+            given = voteValue
 
-        if positive:
-            upd_q = target_model.update(
-                score=target_model.score + voteValue, upvotes=target_model.upvotes + 1
-            )
+        if target_type == "post":
+            target_pk = SubPost.pid
         else:
-            upd_q = target_model.update(
-                score=target_model.score + voteValue,
-                downvotes=target_model.downvotes + 1,
-            )
-        new_score = voteValue
-        User.update(score=User.score + voteValue).where(
-            User.uid == target.uid
-        ).execute()
-        User.update(given=User.given + voteValue).where(User.uid == uid).execute()
-
-    if target_type == "post":
-        upd_q.where(SubPost.pid == target.id).execute()
-        socketio.emit(
-            "threadscore",
-            {"pid": target.id, "score": target.score + new_score},
-            namespace="/snt",
-            room=target.id,
-        )
-
-        socketio.emit(
-            "yourvote",
-            {
-                "pid": target.id,
-                "status": voteValue if not undone else 0,
-                "score": target.score + new_score,
-            },
-            namespace="/snt",
-            room="user" + uid,
-        )
-    else:
-        upd_q.where(SubPostComment.cid == target.id).execute()
-
-    socketio.emit(
-        "uscore",
-        {"score": target.uid.score + new_score},
-        namespace="/snt",
-        room="user" + target.uid_id,
+            target_pk = SubPostComment.cid
+        target_model.update(
+            score=target_model.score + new_score,
+            upvotes=target_model.upvotes + upvotes,
+            downvotes=target_model.downvotes + downvotes,
+        ).where(target_pk == target.id).execute()
+        if not config.site.defer_user_scores:
+            User.update(score=User.score + new_score).where(
+                User.uid == target.uid_id
+            ).execute()
+            User.update(given=User.given + given).where(User.uid == uid).execute()
+
+    if config.site.defer_user_scores:
+        defer_user_score_deltas(target.uid_id, new_score, uid, given)
+    bump_post_version(target.id if target_type == "post" else target.pid_id)
+
+    socketio.start_background_task(
+        broadcast_vote,
+        target_type,
+        target.id,
+        uid,
+        target.score + new_score,
+        voteValue if not undone else 0,
+        target.uid_id,
+        target.author_score + new_score,
     )
 
     return jsonify(score=target.score + new_score, rm=undone)
 
 
+@memoize_per_request
 def is_sub_mod(uid, sid, power_level, can_admin=False):
     try:
         SubMod.get(
@@ -2702,6 +2969,8 @@ def getReports(view, status, page, *_args, **kwargs):
     report_type = kwargs.get("type", None)
     report_id = kwargs.get("report_id", None)
     related = kwargs.get("related", None)
+    # Only count the open and closed reports
+    counts_only = kwargs.get("counts_only", False)
 
     # Get all reports on posts and comments for requested subs,
     Reported = User.alias()
@@ -2870,29 +3139,31 @@ def getReports(view, status, page, *_args, **kwargs):
         open_query = open_sub_post_reports | open_sub_comment_reports
         closed_query = closed_sub_post_reports | closed_sub_comment_reports
 
-    open_report_count = open_query.count()
-    closed_report_count = closed_query.count()
-
-    # Order and paginate queries
-    if status == "open":
-        query = open_query.order_by(open_query.c.datetime.desc())
-        query = query.paginate(page, 50)
-    elif status == "closed":
-        query = closed_query.order_by(closed_query.c.datetime.desc())
-        query = query.paginate(page, 50)
-    elif status == "all":
-        query = open_query | closed_query
-        query = query.order_by(closed_query.c.datetime.desc())
-        query = query.paginate(page, 50)
-    else:
+    all_query = open_query | closed_query
+    if status not in ("open", "closed", "all"):
         return jsonify(msg=_("Invalid status request")), 400
 
-    if report_id and report_type and not related:
-        # If only getting one report, this is a more usable format
-        return list(query.dicts())[0]
+    if not counts_only:
+        # Order and paginate queries
+        query = {"open": open_query, "closed": closed_query, "all": all_query}[status]
+        query = query.order_by(query.c.datetime.desc()).paginate(page, 50)
+
+        if report_id and report_type and not related:
+            # If only getting one report, this is a more usable format
+            return list(query.dicts())[0]
+
+    # Count both open and closed reports with a single query
+    counts = all_query.select_from(all_query.c.open, fn.COUNT(SQL("*")))
+    counts = counts.group_by(all_query.c.open).tuples()
+    open_report_count = closed_report_count = 0
+    for is_open, count in counts:
+        if is_open:
+            open_report_count += count
+        else:
+            closed_report_count += count
 
     return {
-        "query": list(query.dicts()),
+        "query": [] if counts_only else list(query.dicts()),
         "open_report_count": str(open_report_count),
         "closed_report_count": str(closed_report_count),
     }
@@ -2917,47 +3188,67 @@ def logging_init_app(app):
         logging.basicConfig(level=logging.WARNING)
 
 
+# Matches the keys used in logging format strings, such as "%(request.path)s".
+LOG_FORMAT_KEY = re.compile(r"%\((.+?)\)")
+
+
 def add_context_to_log_records(config):
     # Extract the keys used in the formatters in config.yaml.
     keys = set()
     if "formatters" in config:
         for formatter in config["formatters"].values():
             if "format" in formatter:
-                keys |= set(re.findall(r"%\((.+?)\)", formatter["format"]))
+                keys |= set(LOG_FORMAT_KEY.findall(formatter["format"]))
+
+    # Split the keys up front, so it isn't done for every log record.
+    request_keys, user_keys, g_keys = [], [], []
+    for k in keys:
+        splits = k.split(".")
+        if len(splits) > 1:
+            var, attr = splits[0:2]
+            if var == "request":
+                header = splits[2] if attr == "headers" and len(splits) == 3 else None
+                request_keys.append((k, attr, header))
+            elif var == "current_user":
+                user_keys.append((k, attr))
+            elif var == "g":
+                g_keys.append((k, attr))
 
     old_factory = logging.getLogRecordFactory()
     if old_factory.__module__ == __name__:  # So the tests don't make a chain of these.
         old_factory = old_factory.old_factory
 
+    # Nothing to fill in, so keep the default factory.
+    if not (request_keys or user_keys or g_keys):
+        logging.setLogRecordFactory(old_factory)
+        return
+
     # If any formatter keys refer to request or current_app, fill in the values.
     def record_factory(*args, **kwargs):
         record = old_factory(*args, **kwargs)
+        values = record.__dict__
         unavailable = ""
-        for k in keys:
-            splits = k.split(".")
-            if len(splits) > 1:
-                var, attr = splits[0:2]
-                if var == "request":
-                    if request:
-                        if attr == "headers" and len(splits) == 3:
-                            record.__dict__[k] = request.headers.get(
-                                splits[2], unavailable
-                            )
-                        else:
-                            record.__dict__[k] = getattr(request, attr, unavailable)
-                    else:
-                        record.__dict__[k] = unavailable
-                elif var == "current_user":
-                    # Peek at the current user but don't load it if not loaded.
-                    if user_is_loaded():
-                        record.__dict__[k] = getattr(current_user, attr, unavailable)
-                    else:
-                        record.__dict__[k] = unavailable
-                elif var == "g":
-                    if has_app_context():
-                        record.__dict__[k] = getattr(g, attr, unavailable)
+        if request_keys:
+            if request:
+                for k, attr, header in request_keys:
+                    if header is not None:
+                        values[k] = request.headers.get(header, unavailable)
                     else:
-                        record.__dict__[k] = unavailable
+                        values[k] = getattr(request, attr, unavailable)
+            else:
+                for k, _attr, _header in request_keys:
+                    values[k] = unavailable
+        if user_keys:
+            # Peek at the current user but don't load it if not loaded.
+            loaded = user_is_loaded()
+            for k, attr in user_keys:
+                values[k] = (
+                    getattr(current_user, attr, unavailable) if loaded else unavailable
+                )
+        if g_keys:
+            available = has_app_context()
+            for k, attr in g_keys:
+                values[k] = getattr(g, attr, unavailable) if available else unavailable
         return record
 
     record_factory.old_factory = old_factory
@@ -3023,39 +3314,63 @@ def recent_activity(sidebar=True):
         post_activity = post_activity.where(SubPost.sid << defaults)
         comment_activity = comment_activity.where(SubPost.sid << defaults)
 
-    activity = comment_activity | post_activity
-    activity = activity.alias("subquery")
-    # This abomination was created to work aroun a bug (?) where mysql won't use the index of the sub table
-    data = activity.select(
-        activity.c.type,
-        activity.c.content,
-        activity.c.user,
-        activity.c.time,
-        activity.c.pid,
-        activity.c.sid,
-        activity.c.nsfw,
-        Sub.name.alias("sub"),
-        Sub.nsfw.alias("sub_nsfw"),
-    )
-    data = data.join(Sub, on=Sub.sid == activity.c.sid)
     if sidebar and config.site.recent_activity.comments_only:
-        data = data.where(activity.c.type == "comment")
-    data = data.order_by(activity.c.time.desc())
-    data = data.limit(config.site.recent_activity.max_entries if sidebar else 50)
-    data = data.dicts().execute(db)
+        data = list(comment_activity.dicts())
+    else:
+        data = list(comment_activity.dicts()) + list(post_activity.dicts())
+    data.sort(key=lambda rec: rec["time"], reverse=True)
+    data = data[: config.site.recent_activity.max_entries if sidebar else 50]
+
+    # Fetch the subs separately, as mysql won't use the index of the sub table
+    # when it is joined to the union of the two queries above.
+    sids = list({rec["sid"] for rec in data})
+    subs = {}
+    if sids:
+        subs = {
+            sub["sid"]: sub
+            for sub in Sub.select(Sub.sid, Sub.name, Sub.nsfw)
+            .where(Sub.sid << sids)
+            .dicts()
+        }
+    data = [rec for rec in data if rec["sid"] in subs]
 
     for rec in data:
+        rec["sub"] = subs[rec["sid"]]["name"]
+        rec["sub_nsfw"] = subs[rec["sid"]]["nsfw"]
         if rec["type"] != "post":
-            parsed = BeautifulSoup(our_markdown(rec["content"]), features="lxml")
-            for spoiler in parsed.findAll("spoiler"):
-                spoiler.string.replace_with("█" * len(spoiler.string))
-            stripped = parsed.findAll(text=True)
-            rec["content"] = word_truncate("".join(stripped).replace("\n", " "), 350)
+            rec["content"] = markdown_summary(rec["content"], 350)
         add_blur(rec)
 
     return data
 
 
+# Matches the spoilers and the tags in the HTML generated by `our_markdown`.
+SPOILER_RE = re.compile(r"<spoiler>(.*?)</spoiler>", re.S)
+TAG_RE = re.compile(r"<[^>]*>")
+
+
+def html_to_text(html):
+    return unescape(TAG_RE.sub("", html))
+
+
+def markdown_summary(text, max_length):
+    """Renders markdown as plain text with spoilers blacked out, truncated
+    to `max_length`. The result is cached by the hash of the text."""
+    key = "md-summary-{0}-{1}-{2}".format(
+        MARKDOWN_RENDERER_VERSION,
+        max_length,
+        hashlib.blake2b(text.encode(), digest_size=16).hexdigest(),
+    )
+    summary = cache.get(key)
+    if summary is None:
+        html = SPOILER_RE.sub(
+            lambda m: "█" * len(html_to_text(m.group(1))), cached_markdown(text)
+        )
+        summary = word_truncate(html_to_text(html).replace("\n", " "), max_length)
+        cache.set(key, summary, timeout=86400)
+    return summary
+
+
 logger = LocalProxy(lambda: current_app.logger)
 
 
@@ -38,9 +38,20 @@ def db_init_app(app):
 
     if "." in engine:
         path, class_name = engine.rsplit(".", 1)
+    elif engine.startswith("Pooled"):
+        path, class_name = "playhouse.pool", engine
     else:
         path, class_name = "peewee", engine
 
+    # Values for the connection pool may come from environment variables.
+    for key, convert in [
+        ("max_connections", int),
+        ("stale_timeout", float),
+        ("timeout", float),
+    ]:
+        if dbconnect.get(key) is not None:
+            dbconnect[key] = convert(dbconnect[key])
+
     try:
         __import__(path)
         module = sys.modules[path]
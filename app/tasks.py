@@ -10,13 +10,14 @@ import uuid
 from bs4 import BeautifulSoup
 from flask import current_app, jsonify
 import gevent
+from gevent import monkey
 from PIL import Image
 import requests
 
 from .config import config
-from .misc import WHITESPACE, logger
+from .misc import WHITESPACE, logger, markdown_summary
 from .storage import store_thumbnail, thumbnail_url
-from .socketio import send_deferred_event
+from .socketio import socketio, send_deferred_event
 
 
 def create_thumbnail(fileid, store):
@@ -171,6 +172,39 @@ def _image_entropy(img):
     return -sum(p * math.log(p, 2) for p in hist if p != 0)
 
 
+def emit_new_comment(content, comment_count, data):
+    """Let the post's viewers and the /all/new feed know about a new comment.
+    Rendering the comment's text for the feed is done in a new gevent thread,
+    so it doesn't delay the response, unless this is a sync worker without
+    gevent.  `data` is the rest of the "comment" event's payload."""
+    if config.app.testing or not monkey.is_module_patched("os"):
+        emit_new_comment_async(content, comment_count, data)
+    else:
+        gevent.spawn(
+            emit_new_comment_async_appctx,
+            current_app._get_current_object(),
+            content,
+            comment_count,
+            data,
+        )
+
+
+def emit_new_comment_async_appctx(app, content, comment_count, data):
+    with app.app_context():
+        emit_new_comment_async(content, comment_count, data)
+
+
+def emit_new_comment_async(content, comment_count, data):
+    socketio.emit(
+        "threadcomments",
+        {"pid": data["pid"], "comments": comment_count},
+        namespace="/snt",
+        room=data["pid"],
+    )
+    data["content"] = markdown_summary(content, 250)
+    socketio.emit("comment", data, namespace="/snt", room="/all/new")
+
+
 def grab_title(url):
     """Start the grab title process.  Returns a response with a token
     which can be used to get the actual title via socketio, once it has
@@ -1,11 +1,10 @@
 """ API endpoints. """
 
 import datetime
-import uuid
-from bs4 import BeautifulSoup
+from collections import defaultdict
 from email_validator import EmailNotValidError
 from flask import Blueprint, jsonify, request, url_for
-from peewee import JOIN, fn
+from peewee import JOIN, fn, Case
 from flask_jwt_extended import (
     JWTManager,
     jwt_required,
@@ -282,10 +281,14 @@ def get_post_list(target):
             JOIN.LEFT_OUTER,
             on=((SubPostVote.pid == SubPost.pid) & (SubPostVote.uid == uid)),
         ).switch(SubPost)
-        subs = SubSubscriber.select().where(SubSubscriber.uid == uid)
-        subs = subs.order_by(SubSubscriber.order.asc())
-        subscribed = [x.sid_id for x in subs if x.status == 1]
-        blocked = [x.sid_id for x in subs if x.status == 2]
+        subs = (
+            SubSubscriber.select(SubSubscriber.sid, SubSubscriber.status)
+            .where((SubSubscriber.uid == uid) & (SubSubscriber.status << (1, 2)))
+            .order_by(SubSubscriber.order.asc())
+            .tuples()
+        )
+        for sid, status in subs:
+            (subscribed if status == 1 else blocked).append(sid)
 
     base_query = (
         base_query.join(User, JOIN.LEFT_OUTER)
@@ -334,22 +337,31 @@ def get_post_list(target):
         base_query = base_query.where(Sub.sid == sub.sid)
 
     base_query = base_query.where(SubPost.deleted == 0)
-    posts = misc.getPostList(base_query, sort, page)
-
-    cnt = base_query.count() - page * 25
-    postList = []
-    for post in posts:
-        if post["userstatus"] == 10:  # account deleted
-            post["user"] = "[Deleted]"
-        post["archived"] = misc.is_archived(post)
-        del post["userstatus"]
-        del post["uid"]
-        post["content"] = (
-            misc.our_markdown(post["content"]) if post["ptype"] != 1 else ""
+    posts = misc.getPostList(base_query, sort, page, lookahead=1)
+    continues = len(posts) > 25
+    posts = posts[:25]
+
+    text_posts = [post for post in posts if post["ptype"] != 1]
+    html = dict(
+        zip(
+            (post["pid"] for post in text_posts),
+            misc.cached_markdown_many([post["content"] for post in text_posts]),
+        )
+    )
+    postList = [
+        dict(
+            post,
+            # Hide the names of deleted accounts
+            user="[Deleted]" if post["userstatus"] == 10 else post["user"],
+            archived=misc.is_archived(post),
+            content=html.get(post["pid"], ""),
         )
-        postList.append(post)
+        for post in posts
+    ]
+    for post in postList:
+        del post["userstatus"], post["uid"]
 
-    return jsonify(posts=postList, sort=sort, continues=True if cnt > 0 else False)
+    return jsonify(posts=postList, sort=sort, continues=continues)
 
 
 @API.route("/post/<sub>/<int:pid>", methods=["GET"])
@@ -357,6 +369,11 @@ def get_post_list(target):
 def get_post(sub, pid):
     """Returns information for a post """
     uid = get_jwt_identity()
+    cache_key = misc.post_cache_key("api-post", pid, sub.lower(), uid)
+    post = cache.get(cache_key)
+    if post is not None:
+        return jsonify(post=post)
+
     base_query = SubPost.select(
         SubPost.nsfw,
         SubPost.content,
@@ -391,14 +408,15 @@ def get_post(sub, pid):
         .join(Sub, JOIN.LEFT_OUTER)
     )
 
-    post = base_query.where(
-        (SubPost.pid == pid) & (fn.Lower(Sub.name) == sub.lower())
-    ).dicts()
-
-    if not post.count():
+    try:
+        post = (
+            base_query.where((SubPost.pid == pid) & (fn.Lower(Sub.name) == sub.lower()))
+            .dicts()
+            .get()
+        )
+    except SubPost.DoesNotExist:
         return jsonify(msg="Post does not exist"), 404
 
-    post = post[0]
     post["deleted"] = True if post["deleted"] != 0 else False
 
     if post["deleted"]:  # Clear data for deleted posts
@@ -411,7 +429,7 @@ def get_post(sub, pid):
 
     post["source"] = post["content"]
     if post["content"]:
-        post["content"] = misc.our_markdown(post["content"])
+        post["content"] = misc.cached_markdown(post["content"])
 
     if post["userstatus"] == 10:
         post["user"] = "[Deleted]"
@@ -430,6 +448,7 @@ def get_post(sub, pid):
     del post["userstatus"]
     del post["uid"]
 
+    cache.set(cache_key, post, timeout=30)
     return jsonify(post=post)
 
 
@@ -470,6 +489,7 @@ def edit_post(sub, pid):
     if (datetime.datetime.utcnow() - post.posted.replace(tzinfo=None)).seconds > 300:
         post.edited = datetime.datetime.utcnow()
     post.save()
+    misc.bump_post_version(post.pid)
     return get_post(sub, pid)
 
 
@@ -534,6 +554,7 @@ def delete_post(sub, pid):
     except SiteMetadata.DoesNotExist:
         pass
     post.save()
+    misc.bump_post_version(post.pid)
     Sub.update(posts=Sub.posts - 1).where(Sub.sid == post.sid).execute()
     return jsonify(), 200
 
@@ -576,24 +597,32 @@ def get_post_comments(_sub, pid):
     provided or absent if no key is provided
     """
     current_user = get_jwt_identity()
-    try:
-        post = SubPost.get(SubPost.pid == pid)
-    except SubPost.DoesNotExist:
+    sid = SubPost.select(SubPost.sid).where(SubPost.pid == pid).scalar()
+    if sid is None:
         return jsonify(msg="Post does not exist"), 404
 
+    # Admins and mods are shown deleted comments, so their trees aren't cached.
+    if misc.sees_deleted_comments(sid):
+        cache_key = None
+    else:
+        cache_key = misc.post_cache_key("api-comments", pid, current_user)
+        comment_tree = cache.get(cache_key)
+        if comment_tree is not None:
+            return jsonify(comments=comment_tree)
+
     # 1 - Fetch all comments (only cid and parentcid)
-    comments = (
+    comments = list(
         SubPostComment.select(SubPostComment.cid, SubPostComment.parentcid)
-        .where(SubPostComment.pid == post.pid)
+        .where(SubPostComment.pid == pid)
         .order_by(SubPostComment.score.desc())
         .dicts()
     )
-    if not comments.count():
+    if not comments:
         return jsonify(comments=[])
 
-    comment_tree = misc.get_comment_tree(
-        post.pid, post.sid.get_id(), comments, uid=current_user
-    )
+    comment_tree = misc.get_comment_tree(pid, sid, comments, uid=current_user)
+    if cache_key is not None:
+        cache.set(cache_key, comment_tree, timeout=30)
     return jsonify(comments=comment_tree)
 
 
@@ -632,27 +661,29 @@ def create_comment(sub, pid):
     if postmeta.get("lock-comments"):
         return jsonify(msg="Comments are closed on this post."), 403
 
-    try:
-        SubMetadata.get(
+    if (
+        SubMetadata.select(SubMetadata.xid)
+        .where(
             (SubMetadata.sid == post.sid)
             & (SubMetadata.key == "ban")
             & (SubMetadata.value == user.uid)
         )
+        .exists()
+    ):
         return jsonify(msg="You are banned on this sub."), 403
-    except SubMetadata.DoesNotExist:
-        pass
 
     if len(content) > 16384:
         return jsonify(msg="Content is too long"), 400
 
     if parentcid:
         try:
-            parent = SubPostComment.get(SubPostComment.cid == parentcid)
+            parent = SubPostComment.get(
+                (SubPostComment.cid == parentcid)
+                & (SubPostComment.pid == post.pid)
+                & SubPostComment.status.is_null(True)
+            )
         except SubPostComment.DoesNotExist:
             return jsonify(msg="Parent comment does not exist"), 404
-
-        if parent.status is not None or parent.pid.pid != post.pid:
-            return jsonify(msg="Parent comment does not exist"), 404
     else:
         parentcid = None
 
@@ -662,7 +693,7 @@ def create_comment(sub, pid):
         content=content,
         parentcid=parentcid,
         time=datetime.datetime.utcnow(),
-        cid=uuid.uuid4(),
+        cid=misc.uuid7(),
         score=0,
         upvotes=0,
         downvotes=0,
@@ -671,28 +702,15 @@ def create_comment(sub, pid):
     SubPost.update(comments=SubPost.comments + 1).where(
         SubPost.pid == post.pid
     ).execute()
-
-    socketio.emit(
-        "threadcomments",
-        {"pid": post.pid, "comments": post.comments + 1},
-        namespace="/snt",
-        room=post.pid,
-    )
+    misc.bump_post_version(post.pid)
 
     defaults = [
         x.value for x in SiteMetadata.select().where(SiteMetadata.key == "default")
     ]
-    comment_res = misc.word_truncate(
-        "".join(
-            BeautifulSoup(misc.our_markdown(comment.content), features="lxml").findAll(
-                text=True
-            )
-        ).replace("\n", " "),
-        250,
-    )
     sub = Sub.get(Sub.name == sub)
-    socketio.emit(
-        "comment",
+    tasks.emit_new_comment(
+        comment.content,
+        post.comments + 1,
         {
             "sub": sub.name,
             "show_sidebar": (
@@ -702,17 +720,13 @@ def create_comment(sub, pid):
             "pid": post.pid,
             "sid": sub.sid,
             "nsfw": post.nsfw or sub.nsfw,
-            "content": comment_res,
             "post_url": url_for("sub.view_post", sub=sub.name, pid=post.pid),
             "sub_url": url_for("sub.view_sub", sub=sub.name),
         },
-        namespace="/snt",
-        room="/all/new",
     )
 
     # 5 - send pm to parent
     if parentcid:
-        parent = SubPostComment.get(SubPostComment.cid == parentcid)
         notif_to = parent.uid_id
         ntype = "COMMENT_REPLY"
     else:
@@ -803,6 +817,7 @@ def edit_comment(_sub, pid, cid):
     comment.content = content
     comment.lastedit = datetime.datetime.utcnow()
     comment.save()
+    misc.bump_post_version(post.pid)
     # TODO: move this block to a function
     comm = (
         SubPostComment.select(
@@ -862,6 +877,7 @@ def delete_comment(_sub, pid, cid):
 
     comment.status = 1
     comment.save()
+    misc.bump_post_version(post.pid)
 
     return jsonify(), 200
 
@@ -1028,20 +1044,18 @@ def create_post():
     if len(title) > 255:
         return jsonify(msg="Post title is too long"), 400
 
-    if misc.get_user_level(uid)[0] < 7:
+    level = misc.get_user_level(uid, user.score)[0]
+    if level < 7:
         today = datetime.datetime.utcnow() - datetime.timedelta(days=1)
-        lposts = (
-            SubPost.select()
-            .where(SubPost.uid == uid)
-            .where(SubPost.sid == sub.sid)
-            .where(SubPost.posted > today)
-            .count()
-        )
-        tposts = (
-            SubPost.select()
+        lposts, tposts = (
+            SubPost.select(
+                fn.COALESCE(fn.SUM(Case(None, [(SubPost.sid == sub.sid, 1)], 0)), 0),
+                fn.COUNT(SubPost.pid),
+            )
             .where(SubPost.uid == uid)
             .where(SubPost.posted > today)
-            .count()
+            .tuples()
+            .get()
         )
         if lposts > 10 or tposts > 25:
             return jsonify(msg="You have posted too much today"), 403
@@ -1058,19 +1072,18 @@ def create_post():
             return jsonify(msg="Link's domain is banned"), 400
 
         recent = datetime.datetime.utcnow() - datetime.timedelta(days=5)
-        try:
-            wpost = (
-                SubPost.select()
-                .where(SubPost.sid == sub.sid)
-                .where(SubPost.link == link)
-            )
-            wpost.where(SubPost.deleted == 0).where(SubPost.posted > recent).get()
+        if (
+            SubPost.select(SubPost.pid)
+            .where(SubPost.sid == sub.sid)
+            .where(SubPost.link == link)
+            .where(SubPost.deleted == 0)
+            .where(SubPost.posted > recent)
+            .exists()
+        ):
             return (
                 jsonify(msg="This link has already been posted recently on this sub"),
                 403,
             )
-        except SubPost.DoesNotExist:
-            pass
     elif ptype == "text":
         post_type = 0
         if link:
@@ -1078,7 +1091,7 @@ def create_post():
         if len(content) > 16384:
             return jsonify(msg="Post content is too long"), 400
 
-    if misc.get_user_level(user.uid)[0] <= 4:
+    if level <= 4:
         check_challenge()
 
     post = SubPost.create(
@@ -1154,7 +1167,8 @@ def search_sub():
     """Search for subs matching the query parameter.  Return, for each sub
     found, its name and a list of the post types allowed."""
     query = request.args.get("query", "")
-    if len(query) < 3 or not misc.allowedNames.match(query):
+    # Sub names are at most 32 characters long, so longer queries can't match.
+    if not 3 <= len(query) <= 32 or not misc.allowedNames.match(query):
         return jsonify(results=[])
 
     query = "%" + query + "%"
@@ -1314,14 +1328,6 @@ def user_overview(username):
 def get_own_user():
     """ Return user info and notifications count for the current user """
     uid = get_jwt_identity()
-    mcount = Message.select(fn.Count(Message.mid)).where(
-        (Message.receivedby == uid) & (Message.mtype == 1) & Message.read.is_null(True)
-    )
-    ncount = Notification.select(fn.Count(Notification.id)).where(
-        (Notification.target == uid) & Notification.read.is_null(True)
-    )
-    user = User.select(mcount.alias("messages"), ncount.alias("notifications"))
-    user = user.where(User.uid == uid).dicts().get()
     return jsonify(
         {
             "user": None,  # TODO: send same stuff as get_user
@@ -1462,9 +1468,10 @@ def get_messages():
     """ Returns an array of received messages """
     uid = get_jwt_identity()
     page = request.args.get("page", default=1, type=int)
+    before = request.args.get("before", default=None, type=int)
     # autoMarkAsRead = request.args.get('autoMarkAsRead', default=True, type=bool)
 
-    msg = misc.get_messages_inbox(page, uid=uid)
+    msg = misc.get_messages_inbox(page, uid=uid, before=before)
 
     return jsonify(messages=[message_fields_for_api(m) for m in msg])
 
@@ -1535,7 +1542,8 @@ def get_sent_messages():
     """ Returns an array of sent messages """
     uid = get_jwt_identity()
     page = request.args.get("page", default=1, type=int)
-    msg = misc.get_messages_sent(page, uid)
+    before = request.args.get("before", default=None, type=int)
+    msg = misc.get_messages_sent(page, uid, before=before)
 
     return jsonify(messages=[message_fields_for_api(m) for m in msg])
 
@@ -1606,6 +1614,10 @@ def get_settings():
     )
 
 
+# Settings that can be changed with set_settings. All of them are booleans.
+SETTING_KEYS = frozenset(("labrat", "nostyles", "nsfw", "nsfw_blur", "nochat"))
+
+
 @API.route("/user/settings", methods=["POST"])
 @jwt_required
 def set_settings():
@@ -1622,29 +1634,21 @@ def set_settings():
     if not settings:
         return jsonify(msg="Missing parameters"), 400
 
-    if [
-        x
-        for x in settings.keys()
-        if x not in ["labrat", "nostyles", "nsfw", "nsfw_blur", "nochat"]
-    ]:
+    if not SETTING_KEYS.issuperset(settings):
         return jsonify(msg="Invalid setting options sent"), 400
 
-    # Apply settings
-    qrys = []
+    # Apply settings, with one query for each distinct value
+    keys_by_value = defaultdict(list)
     for sett in settings:
         value = settings[sett]
-        if sett in ["labrat", "nostyles", "nsfw", "nsfw_blur", "nochat"]:
-            if not isinstance(settings[sett], bool):
-                return jsonify(msg="Invalid type for setting"), 400
-            value = "1" if value else "0"
-
-        qrys.append(
-            UserMetadata.update(value=value).where(
-                (UserMetadata.key == sett) & (UserMetadata.uid == uid)
-            )
-        )
+        if not isinstance(value, bool):
+            return jsonify(msg="Invalid type for setting"), 400
+        keys_by_value["1" if value else "0"].append(sett)
 
-    [x.execute() for x in qrys]
+    for value, keys in keys_by_value.items():
+        UserMetadata.update(value=value).where(
+            (UserMetadata.key << keys) & (UserMetadata.uid == uid)
+        ).execute()
     return jsonify()
 
 
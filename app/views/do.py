@@ -283,7 +283,7 @@ def edit_user():
 
         usr = User.get(User.uid == current_user.uid)
         usr.language = form.language.data
-        session["language"] = form.language.data
+        misc.set_session_language(form.language.data)
         usr.save()
         current_user.update_prefs("labrat", form.experimental.data)
         current_user.update_prefs("nostyles", form.disable_sub_style.data)
@@ -407,6 +407,7 @@ def delete_post():
 
         post.deleted = deletion
         post.save()
+        misc.bump_post_version(post.pid)
 
         return jsonify(status="ok")
     return jsonify(status="ok", error=get_errors(form))
@@ -474,6 +475,7 @@ def undelete_post():
 
         post.deleted = deletion
         post.save()
+        misc.bump_post_version(post.pid)
 
         return jsonify(status="ok")
     return jsonify(status="ok", error=get_errors(form))
@@ -753,6 +755,7 @@ def assign_post_flair(sub, pid, fl):
 
             post.flair = flair.text
             post.save()
+            misc.bump_post_version(post.pid)
 
             return jsonify(status="ok")
         else:
@@ -781,6 +784,7 @@ def remove_post_flair(sub, pid):
         else:
             post.flair = None
             post.save()
+            misc.bump_post_version(post.pid)
 
         return jsonify(status="ok")
     else:
@@ -1183,6 +1187,7 @@ def edit_txtpost(pid):
         ).seconds > 300:
             post.edited = datetime.datetime.utcnow()
         post.save()
+        misc.bump_post_version(post.pid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -1273,7 +1278,7 @@ def create_comment(pid):
             content=form.comment.data.encode(),
             parentcid=form.parent.data if form.parent.data != "0" else None,
             time=datetime.datetime.utcnow(),
-            cid=uuid.uuid4(),
+            cid=misc.uuid7(),
             score=0,
             upvotes=0,
             downvotes=0,
@@ -1281,6 +1286,7 @@ def create_comment(pid):
         SubPost.update(comments=SubPost.comments + 1).where(
             SubPost.pid == post.pid
         ).execute()
+        misc.bump_post_version(post.pid)
 
         socketio.emit(
             "threadcomments",
@@ -2419,6 +2425,7 @@ def set_sticky_comment(comment):
             SubPostMetadata.create(pid=comment.pid, key="sticky_cid", value=comment.cid)
             comment.distinguish = 1 if is_mod else 2
         comment.save()
+        misc.bump_post_version(comment.pid_id)
 
     return jsonify(status="ok")
 
@@ -2723,6 +2730,7 @@ def edit_comment():
         comment.content = form.text.data
         comment.lastedit = dt
         comment.save()
+        misc.bump_post_version(comment.pid_id)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)[0]})
 
@@ -2786,6 +2794,7 @@ def delete_comment():
             comment.status = 1
 
         comment.save()
+        misc.bump_post_version(comment.pid_id)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -2841,6 +2850,7 @@ def undelete_comment():
             )
         comment.status = 0
         comment.save()
+        misc.bump_post_version(comment.pid_id)
 
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
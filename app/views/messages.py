@@ -38,6 +38,7 @@ def view_notifications(page):
     Notification.update(read=datetime.utcnow()).where(
         (Notification.read.is_null(True)) & (Notification.target == current_user.uid)
     ).execute()
+    current_user.unread_notifications = 0
     return engine.get_template("user/messages/notifications.html").render(
         {"notifications": notifications, "postmeta": postmeta}
     )
@@ -31,7 +31,7 @@ def index():
         # get the sub sid
         this_sub = Sub.select().where(Sub.sid == sub.sid).get()
         sid = str(this_sub.sid)
-        reports = getReports("mod", "all", 1, sid=sid)
+        reports = getReports("mod", "all", 1, sid=sid, counts_only=True)
         # add open_report_count and closed_report_count as properties on sub
         open_reports_count = reports["open_report_count"]
         closed_reports_count = reports["closed_report_count"]
@@ -0,0 +1,21 @@
+import click
+from flask.cli import AppGroup
+from app.misc import fill_captcha_pool
+
+captcha = AppGroup(
+    "captcha",
+    help="""Manages the pool of pre-rendered captchas
+
+Rendering a captcha image is slow, so they can be rendered ahead of time (for example from a cron job)
+and handed out to users from the pool. When the pool is empty, captchas are rendered on demand.
+""",
+)
+
+
+@captcha.command(help="Renders captchas until the pool is full")
+@click.option(
+    "--size", default=1000, help="Number of captchas to keep in the pool.", type=int
+)
+def fill(size):
+    added = fill_captcha_pool(size)
+    print(f"Added {added} captchas to the pool.")
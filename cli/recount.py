@@ -1,5 +1,6 @@
 import click
 from flask.cli import AppGroup
+from app.misc import flush_user_score_deltas
 from app.models import Sub, SubSubscriber
 
 recount = AppGroup("recount", help="Re-count various internal counters")
@@ -32,3 +33,12 @@ def subscribers(save):
                 .where((SubSubscriber.sid == sub.sid) & (SubSubscriber.status == 1))
                 .count()
             ).where(Sub.sid == sub.sid).execute()
+
+
+@recount.command(
+    name="flush-scores",
+    help="Writes the user score changes accumulated when site.defer_user_scores is enabled",
+)
+def flush_scores():
+    updated = flush_user_score_deltas()
+    print(f"Updated the scores of {updated} users.")
@@ -0,0 +1,22 @@
+"""Peewee migrations -- 034_unread_indexes.py
+
+Add indexes used by the unread message and notification counts
+which are computed for every logged in user on every request.
+
+"""
+
+import peewee as pw
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    migrator.add_index("user_unread_message", "uid", "mid", unique=False)
+    migrator.add_index("user_message_mailbox", "uid", "mid", "mailbox", unique=False)
+    migrator.add_index("notification", "receivedby", "read", unique=False)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    migrator.drop_index("user_unread_message", "uid", "mid")
+    migrator.drop_index("user_message_mailbox", "uid", "mid", "mailbox")
+    migrator.drop_index("notification", "receivedby", "read")
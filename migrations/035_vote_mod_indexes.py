@@ -0,0 +1,23 @@
+"""Peewee migrations -- 035_vote_mod_indexes.py
+
+Add compound indexes for looking up a user's vote on a post or comment
+and a user's mod status on a sub, which happen on every vote and on most
+page views.
+
+"""
+
+import peewee as pw
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    migrator.add_index("sub_post_vote", "pid", "uid", unique=False)
+    migrator.add_index("sub_post_comment_vote", "cid", "uid", unique=False)
+    migrator.add_index("sub_mod", "sid", "uid", unique=False)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    migrator.drop_index("sub_post_vote", "pid", "uid")
+    migrator.drop_index("sub_post_comment_vote", "cid", "uid")
+    migrator.drop_index("sub_mod", "sid", "uid")
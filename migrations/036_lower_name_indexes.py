@@ -0,0 +1,30 @@
+"""Peewee migrations -- 036_lower_name_indexes.py
+
+Add expression indexes on the lowercased user and sub names, which are
+used for the case insensitive lookups done on login, user pages and
+sub pages.
+
+MySQL and MariaDB are skipped, since they don't accept this index
+syntax.
+
+"""
+
+import peewee as pw
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    if isinstance(database, pw.MySQLDatabase):
+        return
+    migrator.sql(
+        'CREATE INDEX IF NOT EXISTS "user_name_lower" ON "user" (LOWER("name"))'
+    )
+    migrator.sql('CREATE INDEX IF NOT EXISTS "sub_name_lower" ON "sub" (LOWER("name"))')
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    if isinstance(database, pw.MySQLDatabase):
+        return
+    migrator.sql('DROP INDEX IF EXISTS "user_name_lower"')
+    migrator.sql('DROP INDEX IF EXISTS "sub_name_lower"')
@@ -0,0 +1,18 @@
+"""Peewee migrations -- 037_subscriber_status_index.py
+
+Add an index for looking up the subs a user has subscribed to or
+blocked, which is done to build the home page and the post lists.
+
+"""
+
+import peewee as pw
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    migrator.add_index("sub_subscriber", "uid", "status", unique=False)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    migrator.drop_index("sub_subscriber", "uid", "status")
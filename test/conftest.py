@@ -137,7 +137,11 @@ def fast_hashing(monkeypatch):
         data.append(salt[-1])
         return bytes(data)
 
+    def check(data, hashed):
+        return just_add_salt(data, hashed) == hashed
+
     monkeypatch.setattr(bcrypt, "hashpw", just_add_salt)
+    monkeypatch.setattr(bcrypt, "checkpw", check)
 
 
 @pytest.fixture
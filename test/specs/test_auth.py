@@ -1,12 +1,14 @@
 import pytest
 from datetime import timedelta
 import json
+from types import SimpleNamespace
 from bs4 import BeautifulSoup
 from flask import url_for
 
-from app import mail
+from app import mail, misc
 from app.auth import email_validation_is_required, auth_provider
-from app.models import UserStatus, User
+from app.models import UserStatus, User, rconn
+from cli.captcha import captcha
 
 from test.utilities import csrf_token, get_value
 from test.utilities import register_user, log_in_user, log_out_current_user
@@ -674,3 +676,51 @@ def test_invite_code_required_for_registration(client, user_info, user2_info):
 
     rv = client.post(url_for("auth.register"), data=data, follow_redirects=True)
     assert b"Log out" in rv.data
+
+
+def test_captcha_pool(app, monkeypatch):
+    """Captchas are handed out from the pool while it lasts, and rendered on
+    demand once it is empty."""
+    rendered = []
+
+    def generate_captcha():
+        rendered.append(f"answer{len(rendered)}")
+        return f"image{len(rendered) - 1}", rendered[-1]
+
+    monkeypatch.setattr(misc, "generate_captcha", generate_captcha)
+    # Captchas are turned off in testing mode.
+    monkeypatch.setattr(
+        misc,
+        "config",
+        SimpleNamespace(
+            app=SimpleNamespace(testing=False, development=False),
+            site=SimpleNamespace(require_captchas=True),
+        ),
+    )
+    rconn.delete(misc.CAPTCHA_POOL_KEY)
+
+    rv = app.test_cli_runner().invoke(captcha, ["fill", "--size", "2"])
+    assert "Added 2 captchas to the pool." in rv.output
+    rv = app.test_cli_runner().invoke(captcha, ["fill", "--size", "2"])
+    assert "Added 0 captchas to the pool." in rv.output
+    assert len(rendered) == 2
+
+    # The pool hands out the captchas in the order they were rendered.
+    for i in range(2):
+        token, image = misc.create_captcha()
+        assert image == f"image{i}"
+        assert rconn.get("cap-" + token).decode() == f"answer{i}"
+    assert rconn.llen(misc.CAPTCHA_POOL_KEY) == 0
+    assert len(rendered) == 2
+
+    # Once the pool is empty they are rendered on demand.
+    token, image = misc.create_captcha()
+    assert image == "image2"
+    assert rconn.get("cap-" + token).decode() == "answer2"
+    assert len(rendered) == 3
+
+    # The stored answer is used to check the response, once.
+    assert not misc.validate_captcha(token, "wrong")
+    token, image = misc.create_captcha()
+    assert misc.validate_captcha(token, "ANSWER3")
+    assert not misc.validate_captcha(token, "answer3")
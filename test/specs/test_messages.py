@@ -1,10 +1,11 @@
 from bs4 import BeautifulSoup
 from flask import url_for
 
-from app.models import User
+from app.models import Message, User
 
 from test.utilities import csrf_token
 from test.utilities import register_user, log_in_user, log_out_current_user
+from test.utilities import log_in_user_api
 
 
 def substrings_present(data, snippets, exclude=False):
@@ -346,3 +347,48 @@ def test_exchange_pm(client, user_info, user2_info):
     soup = BeautifulSoup(rv.data, "html.parser")
     link = soup.find(href=url_for("messages.inbox_sort"))
     assert link.get_text().strip() == "0"
+
+
+def test_api_messages_before(client, user_info, user2_info):
+    """Page through received and sent messages in the API with `before`."""
+    username = user_info["username"]
+    register_user(client, user_info)
+    register_user(client, user2_info)
+    headers = log_in_user_api(client, user2_info)
+    user_headers = log_in_user_api(client, user_info)
+
+    # User2 sends User more messages than fit on one page.
+    for i in range(25):
+        rv = client.post(
+            url_for("apiv3.send_message"),
+            json=dict(to=username, subject=f"Testing {i}", content=f"Content {i}"),
+            headers=headers,
+        )
+        assert rv.status_code == 200
+
+    expected = [
+        m.mid
+        for m in Message.select(Message.mid)
+        .join(User, on=User.uid == Message.sentby)
+        .where(User.name == user2_info["username"])
+        .order_by(Message.mid.desc())
+    ]
+    assert len(expected) == 25
+
+    for endpoint, hdrs in [
+        ("apiv3.get_messages", user_headers),
+        ("apiv3.get_sent_messages", headers),
+    ]:
+        rv = client.get(url_for(endpoint), headers=hdrs)
+        page1 = [m["id"] for m in rv.get_json()["messages"]]
+        assert len(page1) == 20
+
+        rv = client.get(url_for(endpoint, before=page1[-1]), headers=hdrs)
+        page2 = [m["id"] for m in rv.get_json()["messages"]]
+        assert len(page2) == 5
+
+        # The pages join up without overlaps or gaps.
+        assert page1 + page2 == expected
+
+        rv = client.get(url_for(endpoint, before=page2[-1]), headers=hdrs)
+        assert rv.get_json()["messages"] == []
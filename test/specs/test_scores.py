@@ -0,0 +1,144 @@
+import pytest
+from flask import url_for
+from peewee import OperationalError
+
+from app.misc import USER_GIVEN_DELTA_KEY, USER_SCORE_DELTA_KEY
+from app.models import User, rconn
+from cli.recount import recount
+
+from test.utilities import register_user, create_sub, submit_text_post
+from test.utilities import log_in_user_api, log_out_current_user
+
+
+def clear_deltas():
+    """Remove deltas left in redis by other tests."""
+    for key in [USER_SCORE_DELTA_KEY, USER_GIVEN_DELTA_KEY]:
+        rconn.delete(key, key + "-flushing")
+
+
+@pytest.mark.parametrize(
+    "test_config",
+    [{"site": {"sub_creation_min_level": 0, "defer_user_scores": True}}],
+)
+def test_deferred_user_scores(app, client, user_info, user2_info, test_config):
+    """With site.defer_user_scores, votes change user scores only when the
+    recount flush-scores command is run."""
+    clear_deltas()
+    register_user(client, user_info)
+    create_sub(client)
+    pid = submit_text_post(client, "Testing!", "Post content")
+    headers = log_in_user_api(client, user_info)
+    register_user(client, user2_info)
+    headers2 = log_in_user_api(client, user2_info)
+    log_out_current_user(client)
+
+    def scores():
+        return {
+            user.name: (user.score, user.given)
+            for user in User.select(User.name, User.score, User.given)
+        }
+
+    # User2 comments on User's post.
+    rv = client.post(
+        url_for("apiv3.create_comment", sub="test", pid=pid),
+        json={"content": "A comment"},
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+    cid = rv.get_json()["comment"]["cid"]
+    before = scores()
+
+    # User2 upvotes the post and User downvotes the comment.
+    rv = client.post(
+        url_for("apiv3.vote_post", _sub="test", pid=pid),
+        json={"upvote": True},
+        headers=headers2,
+    )
+    assert rv.get_json()["score"] == 2
+    rv = client.post(
+        url_for("apiv3.vote_comment", _sub="test", _pid=pid, cid=cid),
+        json={"upvote": False},
+        headers=headers,
+    )
+    assert rv.get_json()["score"] == -1
+
+    # The user scores haven't changed yet.
+    assert scores() == before
+
+    rv = app.test_cli_runner().invoke(recount, ["flush-scores"])
+    assert "Updated the scores of 2 users." in rv.output
+
+    username, username2 = user_info["username"], user2_info["username"]
+    after = scores()
+    assert after[username] == (before[username][0] + 1, before[username][1] - 1)
+    assert after[username2] == (before[username2][0] - 1, before[username2][1] + 1)
+
+    # Running it again changes nothing.
+    rv = app.test_cli_runner().invoke(recount, ["flush-scores"])
+    assert "Updated the scores of 0 users." in rv.output
+    assert scores() == after
+
+
+@pytest.mark.parametrize(
+    "test_config",
+    [{"site": {"sub_creation_min_level": 0, "defer_user_scores": True}}],
+)
+def test_deferred_user_scores_failed_flush(
+    app, client, user_info, user2_info, test_config, monkeypatch
+):
+    """Deltas that fail to be written are kept and written by the next run."""
+    clear_deltas()
+    register_user(client, user_info)
+    create_sub(client)
+    pid = submit_text_post(client, "Testing!", "Post content")
+    headers = log_in_user_api(client, user_info)
+    register_user(client, user2_info)
+    headers2 = log_in_user_api(client, user2_info)
+    log_out_current_user(client)
+    user = User.get(User.name == user_info["username"])
+    user2 = User.get(User.name == user2_info["username"])
+
+    # User2 upvotes User's post.
+    rv = client.post(
+        url_for("apiv3.vote_post", _sub="test", pid=pid),
+        json={"upvote": True},
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+
+    # The database fails during the flush.
+    def failing_update(*args, **kwargs):
+        raise OperationalError("database is gone")
+
+    with monkeypatch.context() as m:
+        m.setattr(User, "update", failing_update)
+        rv = app.test_cli_runner().invoke(recount, ["flush-scores"])
+    assert isinstance(rv.exception, OperationalError)
+
+    # Nothing was written, and the deltas are kept.
+    assert User.get_by_id(user.uid).score == user.score
+    assert User.get_by_id(user2.uid).given == user2.given
+    assert rconn.exists(USER_SCORE_DELTA_KEY + "-flushing")
+
+    # User2 upvotes a comment by User before the next run.
+    rv = client.post(
+        url_for("apiv3.create_comment", sub="test", pid=pid),
+        json={"content": "A comment"},
+        headers=headers,
+    )
+    cid = rv.get_json()["comment"]["cid"]
+    rv = client.post(
+        url_for("apiv3.vote_comment", _sub="test", _pid=pid, cid=cid),
+        json={"upvote": True},
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+
+    # The next run writes the deltas of both votes.
+    rv = app.test_cli_runner().invoke(recount, ["flush-scores"])
+    assert rv.exit_code == 0
+    assert User.get_by_id(user.uid).score == user.score + 2
+    assert User.get_by_id(user2.uid).given == user2.given + 2
+    for key in [USER_SCORE_DELTA_KEY, USER_GIVEN_DELTA_KEY]:
+        assert not rconn.exists(key)
+        assert not rconn.exists(key + "-flushing")
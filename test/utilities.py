@@ -3,7 +3,7 @@ from flask import url_for
 from peewee import fn
 from app import mail
 from app.auth import email_validation_is_required
-from app.models import User, UserMetadata, SiteMetadata
+from app.models import User, UserMetadata, SiteMetadata, SubPost
 
 
 def csrf_token(data):
@@ -127,6 +127,23 @@ def create_sub(client, allow_polls=False):
     assert b"/s/test" in rv.data
 
 
+def submit_text_post(client, title, content, sub="test"):
+    """Submit a text post as the logged-in user and return its pid."""
+    rv = client.get(url_for("subs.submit", ptype="text", sub=sub))
+    data = {
+        "csrf_token": csrf_token(rv.data),
+        "ptype": "text",
+        "title": title,
+        "content": content,
+    }
+    client.post(
+        url_for("subs.submit", ptype="text", sub=sub),
+        data=data,
+        follow_redirects=True,
+    )
+    return SubPost.get(SubPost.title == title).pid
+
+
 def promote_user_to_admin(client, user_info):
     """Assuming user_info is the info for the logged-in user, promote them
     to admin and leave them logged in.
@@ -135,3 +152,14 @@ def promote_user_to_admin(client, user_info):
     admin = User.get(fn.Lower(User.name) == user_info["username"])
     UserMetadata.create(uid=admin.uid, key="admin", value="1")
     log_in_user(client, user_info)
+
+
+def log_in_user_api(client, user_info):
+    """Log in the user described by the user_info dictionary through the
+    API, and return the headers to authenticate API requests with."""
+    rv = client.post(
+        url_for("apiv3.login"),
+        json=dict(username=user_info["username"], password=user_info["password"]),
+    )
+    assert rv.status_code == 200
+    return {"Authorization": "Bearer " + rv.get_json()["access_token"]}
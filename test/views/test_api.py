@@ -0,0 +1,205 @@
+import pytest
+from flask import url_for
+from test.utilities import register_user, create_sub, submit_text_post
+from test.utilities import log_in_user, log_in_user_api, log_out_current_user
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_get_post_after_changes(client, user_info, user2_info, test_config):
+    """The API returns fresh post data after the post is edited, voted on or
+    deleted."""
+    register_user(client, user_info)
+    create_sub(client)
+    pid = submit_text_post(client, "Testing!", "Original content")
+    headers = log_in_user_api(client, user_info)
+    register_user(client, user2_info)
+    headers2 = log_in_user_api(client, user2_info)
+    log_out_current_user(client)
+    post_url = url_for("apiv3.get_post", sub="test", pid=pid)
+
+    rv = client.get(post_url, headers=headers)
+    assert rv.status_code == 200
+    assert "Original content" in rv.get_json()["post"]["content"]
+    rv = client.get(post_url, headers=headers2)
+    post = rv.get_json()["post"]
+    assert post["score"] == 1
+    assert post["positive"] is None
+
+    # The author edits the post.
+    rv = client.patch(post_url, json={"content": "Edited content"}, headers=headers)
+    assert rv.status_code == 200
+    for hdrs in [headers, headers2, {}]:
+        rv = client.get(post_url, headers=hdrs)
+        post = rv.get_json()["post"]
+        assert "Edited content" in post["content"]
+        assert post["source"] == "Edited content"
+
+    # User2 upvotes the post.
+    rv = client.post(
+        url_for("apiv3.vote_post", _sub="test", pid=pid),
+        json={"upvote": True},
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+    rv = client.get(post_url, headers=headers2)
+    post = rv.get_json()["post"]
+    assert post["score"] == 2
+    assert post["upvotes"] == 2
+    assert post["positive"]
+    rv = client.get(post_url)
+    assert rv.get_json()["post"]["score"] == 2
+
+    # User2 takes the vote back.
+    rv = client.post(
+        url_for("apiv3.vote_post", _sub="test", pid=pid),
+        json={"upvote": True},
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+    rv = client.get(post_url, headers=headers2)
+    post = rv.get_json()["post"]
+    assert post["score"] == 1
+    assert post["positive"] is None
+
+    # The author deletes the post.
+    rv = client.delete(post_url, headers=headers)
+    assert rv.status_code == 200
+    rv = client.get(post_url, headers=headers2)
+    post = rv.get_json()["post"]
+    assert post["deleted"]
+    assert post["content"] is None
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_get_post_comments_after_changes(client, user_info, user2_info, test_config):
+    """The API returns a fresh comment tree after comments are added, edited,
+    voted on or deleted."""
+    register_user(client, user_info)
+    create_sub(client)
+    pid = submit_text_post(client, "Testing!", "Post content")
+    headers = log_in_user_api(client, user_info)
+    register_user(client, user2_info)
+    headers2 = log_in_user_api(client, user2_info)
+    log_out_current_user(client)
+    comments_url = url_for("apiv3.get_post_comments", _sub="test", pid=pid)
+
+    def get_comments(hdrs):
+        rv = client.get(comments_url, headers=hdrs)
+        assert rv.status_code == 200
+        return rv.get_json()["comments"]
+
+    # User2 comments on the post.
+    rv = client.post(
+        url_for("apiv3.create_comment", sub="test", pid=pid),
+        json={"content": "First comment"},
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+    cid = rv.get_json()["comment"]["cid"]
+    for hdrs in [headers, headers2]:
+        comments = get_comments(hdrs)
+        assert [c["cid"] for c in comments] == [cid]
+        assert comments[0]["source"] == "First comment"
+        assert comments[0]["score"] == 0
+    rv = client.get(url_for("apiv3.get_post", sub="test", pid=pid), headers=headers)
+    assert rv.get_json()["post"]["comments"] == 1
+
+    # The author replies to it.
+    rv = client.post(
+        url_for("apiv3.create_comment", sub="test", pid=pid),
+        json={"content": "A reply", "parentcid": cid},
+        headers=headers,
+    )
+    assert rv.status_code == 200
+    reply_cid = rv.get_json()["comment"]["cid"]
+    for hdrs in [headers, headers2]:
+        children = get_comments(hdrs)[0]["children"]
+        assert [c["cid"] for c in children] == [reply_cid]
+    rv = client.get(url_for("apiv3.get_post", sub="test", pid=pid), headers=headers)
+    assert rv.get_json()["post"]["comments"] == 2
+
+    # User2 edits the comment.
+    rv = client.patch(
+        url_for("apiv3.edit_comment", _sub="test", pid=pid, cid=cid),
+        json={"content": "Edited comment"},
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+    for hdrs in [headers, headers2]:
+        comment = get_comments(hdrs)[0]
+        assert comment["source"] == "Edited comment"
+        assert "Edited comment" in comment["content"]
+
+    # The author upvotes the comment.
+    rv = client.post(
+        url_for("apiv3.vote_comment", _sub="test", _pid=pid, cid=cid),
+        json={"upvote": True},
+        headers=headers,
+    )
+    assert rv.status_code == 200
+    comment = get_comments(headers)[0]
+    assert comment["score"] == 1
+    assert comment["positive"]
+    assert get_comments(headers2)[0]["score"] == 1
+
+    # User2 deletes the comment.
+    rv = client.delete(
+        url_for("apiv3.delete_comment", _sub="test", pid=pid, cid=cid),
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+    for hdrs in [headers, headers2]:
+        comment = get_comments(hdrs)[0]
+        assert comment["status"] == 1
+        assert comment["content"] == ""
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_get_post_comments_mod_view(client, user_info, user2_info, test_config):
+    """Deleted comments shown to a mod are not served from the cache to
+    other users."""
+    register_user(client, user_info)
+    create_sub(client)
+    pid = submit_text_post(client, "Testing!", "Post content")
+    register_user(client, user2_info)
+    headers2 = log_in_user_api(client, user2_info)
+    log_out_current_user(client)
+    comments_url = url_for("apiv3.get_post_comments", _sub="test", pid=pid)
+
+    # User2 comments on the post and deletes the comment.
+    rv = client.post(
+        url_for("apiv3.create_comment", sub="test", pid=pid),
+        json={"content": "Deleted comment"},
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+    cid = rv.get_json()["comment"]["cid"]
+    rv = client.delete(
+        url_for("apiv3.delete_comment", _sub="test", pid=pid, cid=cid),
+        headers=headers2,
+    )
+    assert rv.status_code == 200
+
+    def get_comment(hdrs):
+        rv = client.get(comments_url, headers=hdrs)
+        assert rv.status_code == 200
+        return rv.get_json()["comments"][0]
+
+    # User, who mods the sub, sees the deleted comment first.
+    log_in_user(client, user_info)
+    comment = get_comment({})
+    assert comment["visibility"] == "mod-self-del"
+    assert comment["source"] == "Deleted comment"
+    log_out_current_user(client)
+
+    # Anonymous users and User2 don't see it afterwards.
+    for hdrs in [{}, headers2]:
+        comment = get_comment(hdrs)
+        assert comment["visibility"] == "none"
+        assert comment["content"] == ""
+        assert comment["source"] == ""
+
+    # And the mod still sees it after them.
+    log_in_user(client, user_info)
+    comment = get_comment({})
+    assert comment["source"] == "Deleted comment"